@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import datetime
 import json
+import logging
 import math
 import os
 import random
-import re
+import threading
 import time
 from email.utils import parsedate
 
@@ -14,6 +16,31 @@ import requests
 import schedule
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def json_dumps(obj):
+        # OPT_NON_STR_KEYS matches stdlib json, which stringifies e.g.
+        # numeric keys coming from YAML profiles
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    json_loads = orjson.loads
+else:
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False)
+
+    json_loads = json.loads
+
+
+logger = logging.getLogger(__name__)
 
 default_ua = 'Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.132 Mobile Safari/532.12'
 
@@ -23,39 +50,56 @@ request_ua = os.getenv('NRTOOL_USER_AGENT', default_ua)
 webapi_endpoint = os.getenv('NRTOOL_API_ENDPOINT')
 webapi_test_endpoint = os.getenv('NRTOOL_API_TEST_ENDPOINT', webapi_endpoint)
 
+os.makedirs(log_dir, exist_ok=True)
+
 if not webapi_endpoint:
     raise Exception('NRTOOL_LOG_PATH is not set')
 
+# shared session so retries and concurrent tasks reuse pooled connections
+session = requests.Session()
+session.headers.update({
+    'User-Agent': request_ua,
+    'DNT': '1',
+    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+    'X-Requested-With': 'XMLHttpRequest',
+})
+_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+
+# single worker keeps log writes ordered while the request thread moves on
+_log_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+def _log_task_done(future):
+    e = future.exception()
+    if e is not None:
+        logger.error('report log write failed: %s', e)
+
 
 def log_task(task_id, date, payload, response):
-    os.makedirs(log_dir, exist_ok=True)
     with open(os.path.join(log_dir, f'report_{task_id}_{date}.log'), 'w', encoding='utf-8') as f:
-        json.dump({
+        f.write(json_dumps({
             'task_id': task_id,
             'payload': payload,
             'response': response
-        }, f, ensure_ascii=False, indent=4)
+        }))
 
 
-@retry(exceptions=requests.exceptions.RequestException, tries=10, delay=10)
+@retry(exceptions=requests.exceptions.RequestException, tries=10, delay=1, max_delay=60, backoff=2, jitter=(0, 5))
 def send_request_with_retry(post_data, cookie):
-    r = requests.post(webapi_endpoint,
-                      headers={
-                          'User-Agent': request_ua,
-                          'DNT': '1',
-                          'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                          'Cookie': cookie,
-                          'X-Requested-With': 'XMLHttpRequest',
-                      }, data=post_data)
-    print(r.json())
+    r = session.post(webapi_endpoint, headers={'Cookie': cookie}, data=post_data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('response: %s', r.text)
     return r
 
 
 def send_request(task_id, data, uid, cookie):
-    now = datetime.datetime.now()
+    now_t = time.time()
 
-    date = now.strftime('%Y%m%d')  # '20200927'
-    created = str(int(time.time()))
+    date = time.strftime('%Y%m%d', time.localtime(now_t))  # '20200927'
+    created = str(int(now_t + server_time_offset))
 
     post_data = {
         **data,
@@ -64,131 +108,161 @@ def send_request(task_id, data, uid, cookie):
         'created': created,
         'id': 8749065
     }
-    print(json.dumps(post_data))
+    logger.debug('post_data: %s', post_data)
 
     r = send_request_with_retry(post_data, cookie)
 
-    log_task(task_id, date, post_data, r.json())
+    future = _log_executor.submit(log_task, task_id, date, post_data, json_loads(r.content))
+    future.add_done_callback(_log_task_done)
 
 
 def rayleigh_dist(sigma, upbound=math.inf):
-    u = random.random()
-    if u > 0:
-        x = sigma * math.sqrt(-2 * math.log(u))
-    else:
-        x = math.inf
-    if x >= upbound:
-        if upbound > 0:
-            return rayleigh_dist(sigma, upbound)
-        else:
-            return upbound
-    else:
-        return x
+    # rejection sampling; iterate instead of recursing so a small
+    # upbound/sigma ratio can't blow the stack
+    sqrt = math.sqrt
+    log = math.log
+    while True:
+        u = random.random()
+        if u == 0.0:
+            continue
+        x = sigma * sqrt(-2.0 * log(u))
+        if x < upbound:
+            return x
+
 
+class TaskPayload:
+    __slots__ = ('id', 'uid', 'cookie', 'profile_path', 'profile_data',
+                 'profile_mtime', 'time', 'rayleigh_sigma', 'rayleigh_upbound')
 
-def do_task(payload, cancel_job=False):
-    print('do task:', json.dumps(payload))
+    def __init__(self, id, uid, cookie):
+        self.id = id
+        self.uid = uid
+        self.cookie = cookie
+        self.profile_path = None
+        self.profile_data = None
+        self.profile_mtime = None
+        self.time = None
+        self.rayleigh_sigma = 0
+        self.rayleigh_upbound = 0
 
-    with open(payload['profile_path'], 'r', encoding='utf-8') as f:
-        data = yaml.load(f, Loader=yaml.FullLoader)
 
-    send_request(payload['id'], data, payload['uid'], payload['cookie'])
+def load_profile(payload):
+    # re-parse only when the profile file changed on disk
+    mtime = os.path.getmtime(payload.profile_path)
+    if payload.profile_data is None or mtime != payload.profile_mtime:
+        with open(payload.profile_path, 'rb') as f:
+            payload.profile_data = yaml.load(f.read(), Loader=SafeLoader)
+        payload.profile_mtime = mtime
+    return payload.profile_data
 
-    if cancel_job:
-        return schedule.CancelJob
+
+def do_task(payload):
+    logger.info('do task: id=%s, uid=%s', payload.id, payload.uid)
+
+    data = load_profile(payload)
+
+    send_request(payload.id, data, payload.uid, payload.cookie)
 
 
 def do_task_check(payload):
-    sigma = payload['rayleigh_sigma']
-    upbound = payload['rayleigh_upbound']
+    sigma = payload.rayleigh_sigma
+    upbound = payload.rayleigh_upbound
     # delay a random period and then send the request
     if sigma > 5 and upbound > 5: # at least 5 secs
         delay_sec = math.floor(rayleigh_dist(sigma, upbound))
         print(f'scheduled to send request after {delay_sec} secs')
-        schedule.every(delay_sec).seconds.do(do_task, payload, cancel_job=True)
+        threading.Timer(delay_sec, do_task, args=(payload,)).start()
     else:
         do_task(payload)
 
 
 def parse_time_string(s):
-    if isinstance(s, str):
-        m = re.match('((?P<min>\d+)m\s*)?((?P<sec>\d+)s)?', s)
-        if not m:
+    # parses '5m30s', '5m' or '30s'; plain numbers are passed through
+    if not isinstance(s, str):
+        return s
+    min, sep, rest = s.partition('m')
+    if sep:
+        if not min:
             return None
-        min = m['min']
-        sec = m['sec']
-        if not min and not sec:
+    else:
+        min, rest = '', s
+    rest = rest.strip()
+    if rest:
+        if not rest.endswith('s'):
             return None
-        min = min or 0
-        sec = sec or 0
-        return 60 * int(min) + int(sec)
+        sec = rest[:-1]
     else:
-        return s
+        sec = ''
+    if not min and not sec:
+        return None
+    if (min and not min.isdecimal()) or (sec and not sec.isdecimal()):
+        return None
+    return 60 * int(min or 0) + int(sec or 0)
+
+
+# send times already validated, so repeats skip the strptime check
+_valid_times = set()
 
 
 def create_task(task):
-    if 'enable' in task and not task['enable']:
+    if not task.get('enable', True):
         print('skip disabled task...')
         return True
-    if 'id' not in task:
-        print('Error: id is not definded')
-        return
-    if 'uid' not in task:
-        print('Error: uid is not definded')
+    missing = [k for k in ('id', 'uid', 'cookie', 'profile') if k not in task]
+    if missing:
+        print(f"Error: {', '.join(missing)} is not definded")
         return
-    if 'cookie' not in task:
-        print('Error: cookie is not definded')
-        return
-    if 'profile' not in task:
-        print('Error: profile is not definded')
-        return
-    payload = {
-        'id': task['id'],
-        'uid': task['uid'],
-        'cookie': task['cookie'],
-        'profile_path': None,
-        'time': None,
-        'rayleigh_sigma': 0,
-        'rayleigh_upbound': 0,
-    }
+    payload = TaskPayload(task['id'], task['uid'], task['cookie'])
 
     profile_path = os.path.join(data_dir, task['profile'])
     if not os.path.exists(profile_path):
-        print(f"Error: id={payload['id']}: profile '{profile_path}' is not found")
+        print(f"Error: id={payload.id}: profile '{profile_path}' is not found")
         return
-    with open(profile_path, 'r', encoding='utf-8') as f:
+    with open(profile_path, 'rb') as f:
         try:
-            yaml.load(f, Loader=yaml.FullLoader)
-        except yaml.parser.ParserError as e:
+            payload.profile_data = yaml.load(f.read(), Loader=SafeLoader)
+        except yaml.YAMLError as e:
             print(f'Invalid YAML file {profile_path}: {e}')
             return
+    payload.profile_mtime = os.path.getmtime(profile_path)
 
-    payload['profile_path'] = profile_path
+    payload.profile_path = profile_path
 
-    if 'rayleigh_sigma' in task:
-        rayleigh_sigma = parse_time_string(task['rayleigh_sigma'])
-        payload['rayleigh_sigma'] = rayleigh_sigma
+    rayleigh_sigma = task.get('rayleigh_sigma')
+    if rayleigh_sigma is not None:
+        rayleigh_sigma = parse_time_string(rayleigh_sigma)
         if rayleigh_sigma is None:
             # TODO: check if rayleigh_sigma is a number
-            print(f'Error: unknown rayleigh_sigma format: {rayleigh_sigma}')
+            print(f"Error: unknown rayleigh_sigma format: {task['rayleigh_sigma']}")
             return
+        payload.rayleigh_sigma = rayleigh_sigma
 
-    if 'rayleigh_upbound' in task:
-        rayleigh_upbound = parse_time_string(task['rayleigh_upbound'])
-        payload['rayleigh_upbound'] = rayleigh_upbound
+    rayleigh_upbound = task.get('rayleigh_upbound')
+    if rayleigh_upbound is not None:
+        rayleigh_upbound = parse_time_string(rayleigh_upbound)
         if rayleigh_upbound is None:
             # TODO: check if rayleigh_upbound is a number
-            print(f'Error: unknown rayleigh_upbound format: {rayleigh_upbound}')
+            print(f"Error: unknown rayleigh_upbound format: {task['rayleigh_upbound']}")
             return
+        payload.rayleigh_upbound = rayleigh_upbound
+
+    base_send_time = task.get('time', '07:00')
+    if base_send_time not in _valid_times:
+        # schedule's .at() accepts HH:MM and HH:MM:SS for daily jobs
+        for fmt in ('%H:%M', '%H:%M:%S'):
+            try:
+                datetime.datetime.strptime(base_send_time, fmt)
+                break
+            except (TypeError, ValueError):
+                pass
+        else:
+            print(f"Error: id={payload.id}: invalid time format: {base_send_time}")
+            return
+        _valid_times.add(base_send_time)
+    payload.time = base_send_time
 
-    if 'time' not in task:
-        base_send_time = '07:00'
-    else:
-        base_send_time = task['time']
-    payload['time'] = base_send_time
-
-    print(f"Loaded task: id={payload['id']}, profile={profile_path}, uid={payload['uid']}, "
-          f"time={base_send_time}+~{payload['rayleigh_sigma']}s")
+    print(f"Loaded task: id={payload.id}, profile={profile_path}, uid={payload.uid}, "
+          f"time={base_send_time}+~{payload.rayleigh_sigma}s")
     schedule.every().day.at(base_send_time).do(do_task_check, payload)
     return True
 
@@ -199,8 +273,8 @@ def load_tasks():
         print(f'Task configuration is not exist: {path}')
         return
 
-    with open(path, 'r', encoding='utf-8') as f:
-        data = yaml.load(f, Loader=yaml.FullLoader)
+    with open(path, 'rb') as f:
+        data = yaml.load(f.read(), Loader=SafeLoader)
         if 'tasks' not in data:
             print('Invalid configuration file')
             return
@@ -211,7 +285,8 @@ def load_tasks():
 
 
 def fetch_server_time():
-    r = requests.get(webapi_test_endpoint)
+    # only the Date header is needed, so skip the response body entirely
+    r = session.head(webapi_test_endpoint, allow_redirects=False)
     t = parsedate(r.headers['Date'])
     return time.mktime(t)
 
@@ -220,13 +295,16 @@ def fetch_server_time():
 server_time_offset = 0
 
 
-@retry(exceptions=Exception, tries=10, delay=20)
+@retry(exceptions=Exception, tries=10, delay=1, max_delay=60, backoff=2, jitter=(0, 10))
 def update_server_time_offset():
+    global server_time_offset
     server_time_offset = fetch_server_time() - datetime.datetime.utcnow().timestamp()
     print('Server time offset: ' + str(server_time_offset))
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
     print('Program started...')
 
     schedule.every().day.at('23:00').do(update_server_time_offset)
@@ -238,4 +316,10 @@ if __name__ == "__main__":
     print('Waiting for the scheduler...')
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        # sleep until the next job instead of polling every second; cap at
+        # 60s so jobs scheduled from within callbacks are picked up promptly
+        idle = schedule.idle_seconds()
+        if idle is None:
+            time.sleep(60)
+        elif idle > 0:
+            time.sleep(min(idle, 60))